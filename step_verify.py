@@ -1,26 +1,35 @@
+import asyncio
+import contextlib
 import functools
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor
-from opentelemetry.sdk import trace as trace_sdk
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry import trace as trace_api
-from openinference.instrumentation.dspy import DSPyInstrumentor
-import phoenix
+import hashlib
+import json
+import logging
+import platform
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+import httpx
+import os
 import re
 import torch
 import tqdm
 from enum import Enum
-from typing import Annotated, Protocol, Tuple, Optional
+from typing import Annotated, Callable, Protocol, Tuple, Optional
 import dspy
-from dspy.predict import Retry
 from dspy.functional import TypedChainOfThought
-from dspy.primitives.assertions import assert_transform_module, backtrack_handler
+from dspy.primitives.assertions import (
+    assert_transform_module,
+    backtrack_handler,
+    bypass_suggest_handler,
+)
 import typer
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoModel
-from concurrent.futures import ThreadPoolExecutor
 
 # TODO: Use Chat Adapters from dspy instead of manually formatting the chat
 
 app = typer.Typer()
+logger = logging.getLogger(__name__)
 
 DEVICE = (
     "cuda"
@@ -30,16 +39,44 @@ DEVICE = (
     else "cpu"
 )
 
+# Half precision only pays off on CUDA tensor cores; bf16 where Ampere+ supports it
+DTYPE = (
+    (torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16)
+    if DEVICE == "cuda"
+    else torch.float32
+)
+
+CACHE_DIR = Path.home() / ".cache" / "llm-verify"
+
+OLLAMA_BASE_URL = "http://localhost:11434"
+# Same per-request limit dspy.OllamaLocal applies, so a stuck Ollama can't hang forward
+OLLAMA_TIMEOUT_S = 120
 
-phoenix.launch_app(host="localhost", port=6006)
-tracer_provider = trace_sdk.TracerProvider()
-tracer_provider.add_span_processor(
-    SimpleSpanProcessor(
-        span_exporter=OTLPSpanExporter(endpoint="http://localhost:6006/v1/traces")
+
+# Tracing is opt-in: launching Phoenix and exporting every span costs each run
+if os.environ.get("LLM_VERIFY_TRACE"):
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk import trace as trace_sdk
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+        OTLPSpanExporter,
     )
-)
-trace_api.set_tracer_provider(tracer_provider=tracer_provider)
-DSPyInstrumentor().instrument()
+    from opentelemetry import trace as trace_api
+    from openinference.instrumentation.dspy import DSPyInstrumentor
+    import phoenix
+
+    phoenix.launch_app(host="localhost", port=6006)
+    tracer_provider = trace_sdk.TracerProvider()
+    tracer_provider.add_span_processor(
+        BatchSpanProcessor(
+            span_exporter=OTLPSpanExporter(
+                endpoint="http://localhost:6006/v1/traces", timeout=5
+            ),
+            max_queue_size=2048,
+            schedule_delay_millis=500,
+        )
+    )
+    trace_api.set_tracer_provider(tracer_provider=tracer_provider)
+    DSPyInstrumentor().instrument()
 
 
 class LanguageModel(str, Enum):
@@ -61,6 +98,9 @@ class StepAnnotation(str, Enum):
     DOES_NOT_SEEM_RIGHT = "does_not_seem_right"
 
 
+_STEP_ANNOTATIONS = tuple(item.value for item in StepAnnotation)
+
+
 class StepVerfication(dspy.Signature):
     objective: str = dspy.InputField()
     chat_history: str = dspy.InputField(
@@ -71,8 +111,7 @@ class StepVerfication(dspy.Signature):
     )
     step_to_be_verified: str = dspy.InputField()
     step_annotation: str = dspy.OutputField(
-        desc=f"""Must be one of the following values: {
-            [item.value for item in StepAnnotation]}"""
+        desc=f"Must be one of the following values: {list(_STEP_ANNOTATIONS)}"
     )
     step_rating: int = dspy.OutputField(
         desc="""A rating between 0 to 5, expressing to what extent to which the given step is both essential and logically valid.
@@ -131,13 +170,93 @@ class Task(dspy.Module):
         return answer
 
 
+def compile_prompt(signature: type[dspy.Signature]) -> Callable[..., str]:
+    """Render a signature into a format template once, asking for a JSON reply, and return its formatter"""
+
+    def literal(text: str) -> str:
+        return text.replace("{", "{{").replace("}", "}}")
+
+    lines = [literal(signature.instructions), ""]
+    for name, field in signature.input_fields.items():
+        lines.append(f"{literal(field.json_schema_extra['prefix'])} {{{name}}}")
+    lines += [
+        "",
+        "Respond with a JSON object with the following keys:",
+        # Chain of thought, as TypedChainOfThought asked for before the outputs
+        "- reasoning: Let's think step by step in order to produce the keys below.",
+    ]
+    for name, field in signature.output_fields.items():
+        lines.append(f"- {name}: {literal(field.json_schema_extra['desc'])}")
+    return "\n".join(lines).format
+
+
+def parse_judgement(raw: str) -> Optional[Tuple[StepAnnotation, float]]:
+    """Annotation and 0-5 rating from the judge's JSON reply, or None when it isn't usable"""
+    try:
+        judgement = json.loads(raw)
+        annotation = StepAnnotation(judgement["step_annotation"])
+        rating = float(judgement["step_rating"])
+    except (ValueError, TypeError, KeyError):
+        return None
+    return (annotation, rating) if 0 <= rating <= 5 else None
+
+
+def ollama_client() -> httpx.AsyncClient:
+    """Client for one batch of judge requests to share a connection pool; close it with `async with`"""
+    return httpx.AsyncClient(
+        base_url=OLLAMA_BASE_URL,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=32),
+        timeout=OLLAMA_TIMEOUT_S,
+    )
+
+
+class JudgementCache:
+    """Persistent exact-match cache of judge responses, keyed on the model, its options and the full prompt"""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS judgements (key TEXT PRIMARY KEY, response TEXT)"
+            )
+
+    def _connect(self) -> contextlib.closing[sqlite3.Connection]:
+        # A short-lived connection per lookup: cheap next to an LLM call, safe
+        # across threads and never left open
+        return contextlib.closing(sqlite3.connect(self.path))
+
+    @staticmethod
+    def _key(model: str, options: dict, prompt: str) -> str:
+        # Sampling options are part of the request, a change must not hit old entries
+        request = json.dumps(options, sort_keys=True)
+        return hashlib.sha256(f"{model}\0{request}\0{prompt}".encode()).hexdigest()
+
+    def get(self, model: str, options: dict, prompt: str) -> Optional[str]:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT response FROM judgements WHERE key = ?",
+                (self._key(model, options, prompt),),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, model: str, options: dict, prompt: str, response: str):
+        with self._connect() as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO judgements VALUES (?, ?)",
+                (self._key(model, options, prompt), response),
+            )
+
+
+_STEP_SPLIT = re.compile(r"(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s")
+
+
 def rationale_to_steps(rationale: str, max_spaces: int = 2) -> list[str]:
-    pattern = r"(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s"
-    sentences = re.split(pattern, rationale)
-    filtered_list = [
-        sentence for sentence in sentences if sentence.count(" ") >= max_spaces
+    return [
+        sentence
+        for sentence in _STEP_SPLIT.split(rationale)
+        if sentence.count(" ") >= max_spaces
     ]
-    return filtered_list
 
 
 class VerificationStrategy(str, Enum):
@@ -160,11 +279,48 @@ class StepVerifierType(Protocol):
         """Verify this step, using this particular step verification method"""
         ...
 
+    def verify_steps(
+        self,
+        objective: str,
+        steps: list[str],
+        reasoning_chain: list[str],
+        chat_history: list[str] = [],
+        fail_fast: bool = False,
+    ) -> list[Optional[Tuple[StepAnnotation, int]]]:
+        """Verify all these steps at once, in the same order as given.
+
+        With fail_fast, verification may stop once a step is rejected; steps
+        left unverified because of that come back as None.
+        """
+        ...
+
 
 class JudgeLmVerifier:
-    def __init__(self, model: str):
-        self.lm = dspy.OllamaLocal(model=model)
-        self.llm_judge = TypedChainOfThought(StepVerfication)
+    def __init__(
+        self,
+        model: str,
+        cache_path: Optional[Path] = CACHE_DIR / "judge_cache.db",
+        temperature: float = 0.0,
+        max_tokens: int = 150,
+        top_p: float = 1,
+        top_k: int = 20,
+        frequency_penalty: float = 0,
+        presence_penalty: float = 0,
+        num_ctx: int = 1024,
+    ):
+        self.model = model
+        # Same sampling defaults dspy.OllamaLocal sent, so judgements stay deterministic
+        self.options = {
+            "temperature": temperature,
+            "num_predict": max_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+            "num_ctx": num_ctx,
+        }
+        self.cache = None if cache_path is None else JudgementCache(cache_path)
+        self.prompt = compile_prompt(StepVerfication)
 
     @property
     def type(self) -> VerificationStrategy:
@@ -178,38 +334,152 @@ class JudgeLmVerifier:
         chat_history: list[str] = [],
     ) -> Tuple[StepAnnotation, int]:
         """Verify this step, using an LLM as a Judge"""
-        with dspy.context(lm=self.lm):
-            judgement = self.llm_judge(
-                objective=objective,
-                step_to_be_verified=step_to_be_verified,
-                reasoning_chain="\n  - ".join(reasoning_chain),
-                chat_history=chat_history,
+
+        async def verify():
+            async with ollama_client() as client:
+                return await self.averify_step(
+                    client,
+                    objective=objective,
+                    step_to_be_verified=step_to_be_verified,
+                    reasoning_chain=reasoning_chain,
+                    chat_history=chat_history,
+                )
+
+        return asyncio.run(verify())
+
+    async def averify_step(
+        self,
+        client: httpx.AsyncClient,
+        objective: str,
+        step_to_be_verified: str,
+        reasoning_chain: list[str],
+        chat_history: list[str] = [],
+    ) -> Tuple[StepAnnotation, int]:
+        """Verify this step, posting the judge prompt straight to Ollama"""
+        prompt = self.prompt(
+            objective=objective,
+            chat_history="\n".join(chat_history),
+            reasoning_chain="\n  - ".join(reasoning_chain),
+            step_to_be_verified=step_to_be_verified,
+        )
+        raw = (
+            None
+            if self.cache is None
+            else self.cache.get(self.model, self.options, prompt)
+        )
+        judgement = None if raw is None else parse_judgement(raw)
+        if judgement is None:
+            response = await client.post(
+                "/api/generate",
+                json={
+                    "model": self.model,
+                    "prompt": prompt,
+                    "format": "json",
+                    "stream": False,
+                    "options": self.options,
+                },
             )
+            response.raise_for_status()
+            raw = response.json()["response"]
+            judgement = parse_judgement(raw)
+            if judgement is not None and self.cache is not None:
+                self.cache.set(self.model, self.options, prompt, raw)
 
-            annotation, score = judgement.step_annotation, (judgement.step_rating * 0.2)
+        if judgement is None:
+            logger.warning("Unusable judgement for %r: %r", step_to_be_verified, raw)
+            annotation, score = StepAnnotation.DOES_NOT_SEEM_RIGHT, 0
+        else:
+            annotation, rating = judgement
+            score = rating * 0.2
 
-            print(annotation, score)
+        logger.debug("Judged %r: %s %s", step_to_be_verified, annotation, score)
 
-            return annotation, score
+        return annotation, score
+
+    def verify_steps(
+        self,
+        objective: str,
+        steps: list[str],
+        reasoning_chain: list[str],
+        chat_history: list[str] = [],
+        fail_fast: bool = False,
+    ) -> list[Optional[Tuple[StepAnnotation, int]]]:
+        """Verify all steps, with their Ollama requests in flight concurrently"""
+
+        async def verify_all():
+            async with ollama_client() as client:
+                tasks = [
+                    asyncio.create_task(
+                        self.averify_step(
+                            client,
+                            objective=objective,
+                            step_to_be_verified=step,
+                            reasoning_chain=reasoning_chain,
+                            chat_history=chat_history,
+                        )
+                    )
+                    for step in steps
+                ]
+                try:
+                    for verified in asyncio.as_completed(tasks):
+                        annotation, _ = await verified
+                        if (
+                            fail_fast
+                            and annotation != StepAnnotation.ESSENTIAL_AND_VALID
+                        ):
+                            break
+                finally:
+                    # Requests still in flight after a rejection or an error are
+                    # wasted work; let them unwind before the client closes
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+            return [task.result() if not task.cancelled() else None for task in tasks]
+
+        return asyncio.run(verify_all())
 
 
 class BertClassifierVerifier:
+    instruction = """Does the following answer meet the objective behind user's messages?
+
+Objectives: {objective}"""
+    # Padded sequence lengths; anything longer is padded to max_length
+    buckets = (32, 64, 128, 256)
+
     def __init__(
         self,
         tokenizer: AutoTokenizer,
         model: AutoModel,
         threshold: float = 0.7,
         debug: bool = True,
+        max_batch: int = 64,
+        max_length: int = 512,
     ):
         self.debug = debug
         self.threshold = threshold
         self.model = model
         self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_length = max_length
+
+        # Pinned host / device buffer pairs per model input, reused across calls
+        self._buffers: dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._buffers_lock = threading.Lock()
+        self._buffers_copied: Optional[torch.cuda.Event] = None
 
     @property
     def type(self) -> VerificationStrategy:
         return VerificationStrategy.BERT_CLASSIFIER
 
+    def prepare_context(
+        self, objective: str, chat_history: list[str] = []
+    ) -> list[int]:
+        """Token ids of the instruction shared by every step verified against this objective"""
+        return self.tokenizer.encode(
+            "\n".join([self.instruction.format(objective=objective), *chat_history]),
+            add_special_tokens=False,
+        )
+
     def verify_step(
         self,
         objective: str,
@@ -218,33 +488,116 @@ class BertClassifierVerifier:
         chat_history: list[str] = [],
     ) -> Tuple[StepAnnotation, int]:
         """Verify this step, using this BERT based classification models such as Cappy"""
-        instruction = f"""Does the following answer meet the objective behind user's messages?
+        return self.verify_steps(
+            objective=objective,
+            steps=[step_to_be_verified],
+            reasoning_chain=reasoning_chain,
+            chat_history=chat_history,
+        )[0]
 
-        Objectives: {objective}
-        """
-        instruction += "\n".join(chat_history + [f"Answer: {step_to_be_verified}"])
-        response = step_to_be_verified
-
-        # print(instruction) if self.debug else ...
-        # print(response) if self.debug else ...
-
-        inputs = self.tokenizer(
-            [
-                (instruction, response),
-            ],
-            return_tensors="pt",
-        ).to(DEVICE)
-        score = self.model(**inputs).logits[0][0].item()
-
-        print(score)
-        return (
+    def verify_steps(
+        self,
+        objective: str,
+        steps: list[str],
+        reasoning_chain: list[str],
+        chat_history: list[str] = [],
+        fail_fast: bool = False,
+    ) -> list[Optional[Tuple[StepAnnotation, int]]]:
+        """Verify all steps with batched forward passes of up to max_batch rows"""
+        if not steps:
+            return []
+
+        context_ids = self.prepare_context(objective, chat_history)
+        answers = self.tokenizer(
+            [f"\nAnswer: {step}" for step in steps], add_special_tokens=False
+        )["input_ids"]
+        responses = self.tokenizer(steps, add_special_tokens=False)["input_ids"]
+
+        rows = [
+            self.tokenizer.prepare_for_model(
+                context_ids + answer,
+                response,
+                truncation=True,
+                max_length=self.max_length,
+            )
+            for answer, response in zip(answers, responses)
+        ]
+
+        # Pad rows only up to their length bucket, so one long step doesn't
+        # drag every short one through its full attention cost
+        buckets: dict[int, list[int]] = {}
+        for index, row in enumerate(rows):
+            length = len(row["input_ids"])
+            bucket = next(
+                (size for size in self.buckets if size >= length), self.max_length
+            )
+            # Never pad past max_length, the pinned buffers are sized for it
+            bucket = min(bucket, self.max_length)
+            buckets.setdefault(bucket, []).append(index)
+
+        order, logits = [], []
+        for bucket, indices in sorted(buckets.items()):
+            for start in range(0, len(indices), self.max_batch):
+                chunk = indices[start : start + self.max_batch]
+                inputs = self.tokenizer.pad(
+                    [rows[index] for index in chunk],
+                    padding="max_length",
+                    max_length=bucket,
+                    return_tensors="pt",
+                )
+                with self._buffers_lock, torch.inference_mode(), torch.autocast(
+                    device_type="cuda", dtype=DTYPE, enabled=DEVICE == "cuda"
+                ):
+                    # .float() copies out of the CUDA graph's reused output memory
+                    outputs = self.model(**self._to_device(inputs))
+                    logits.append(outputs.logits[:, 0].float())
+                order += chunk
+
+        # A single device sync for the whole call, instead of one per chunk
+        scores = [0.0] * len(rows)
+        for index, score in zip(order, torch.cat(logits).cpu().tolist()):
+            scores[index] = score
+
+        logger.debug("Cappy scores: %s", scores)
+        return [
             (
-                StepAnnotation.DOES_NOT_SEEM_RIGHT
-                if score <= self.threshold
-                else StepAnnotation.ESSENTIAL_AND_VALID
-            ),
-            score,
-        )
+                (
+                    StepAnnotation.DOES_NOT_SEEM_RIGHT
+                    if score <= self.threshold
+                    else StepAnnotation.ESSENTIAL_AND_VALID
+                ),
+                score,
+            )
+            for score in scores
+        ]
+
+    def _to_device(self, inputs: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+        """Stage the batch through persistent pinned buffers rather than allocating and copying afresh"""
+        if DEVICE != "cuda":
+            return {name: tensor.to(DEVICE) for name, tensor in inputs.items()}
+
+        # Nothing syncs between chunks any more, so the previous batch's
+        # async copy must finish before its host buffers are overwritten
+        if self._buffers_copied is not None:
+            self._buffers_copied.synchronize()
+
+        staged = {}
+        for name, tensor in inputs.items():
+            if name not in self._buffers:
+                size = self.max_batch * self.max_length
+                self._buffers[name] = (
+                    torch.empty(size, dtype=torch.long, pin_memory=True),
+                    torch.empty(size, dtype=torch.long, device=DEVICE),
+                )
+            host, device = self._buffers[name]
+            host = host[: tensor.numel()].view_as(tensor)
+            device = device[: tensor.numel()].view_as(tensor)
+            host.copy_(tensor)
+            device.copy_(host, non_blocking=True)
+            staged[name] = device
+        self._buffers_copied = torch.cuda.Event()
+        self._buffers_copied.record()
+        return staged
 
 
 # class RmVerifier:
@@ -299,47 +652,137 @@ class VerifiedQA(dspy.Module):
             msg="There should atleast be 2 steps in our rationale, or its probably not a good rationale.",
         )
 
-        print(f"{len(steps)=}")
+        logger.debug("Rationale split into %d steps", len(steps))
 
-        def process_step(step):
-            annotation, score = self.step_verifier.verify_step(
-                objective=structured_message.what_is_user_objective,
+        def respond() -> dspy.Prediction:
+            return self.conversational(
+                raw_message_from_user=message,
+                structured_message=str(structured_message),
+                rationale=answer.answer,
+            )
+
+        objective = structured_message.what_is_user_objective
+        # Only stop early when a rejection will raise. Under bypass_suggest_handler
+        # (chat without --retry) and on backtrack_handler's last attempt Suggest
+        # only logs, so every step is verified; a bare call raises as usual
+        fail_fast = not dspy.settings.bypass_suggest
+
+        # Cappy scores the response in the same forward pass as the steps, which
+        # is worth generating it up front; other verifiers gain nothing from that
+        response, objective_verdict = None, None
+        if (
+            self.objective_verifier is self.step_verifier
+            and self.step_verifier.type == VerificationStrategy.BERT_CLASSIFIER
+        ):
+            response = respond()
+            *verdicts, objective_verdict = self.step_verifier.verify_steps(
+                objective=objective,
                 chat_history=chat_history + [message],
                 reasoning_chain=steps,
-                step_to_be_verified=step,
+                steps=steps + [response.response_to_user],
+                fail_fast=fail_fast,
             )
-            dspy.Suggest(
-                result=annotation == StepAnnotation.ESSENTIAL_AND_VALID.value,
-                msg="Each step in the thought process must be necessary for reaching an answer and be logically and factually valid.",
+        else:
+            verdicts = self.step_verifier.verify_steps(
+                objective=objective,
+                chat_history=chat_history + [message],
+                reasoning_chain=steps,
+                steps=steps,
+                fail_fast=fail_fast,
             )
-            print("Suggest Passed!")
-            return step, score
 
+        chosen_steps = []
         try:
-            with ThreadPoolExecutor(max_workers=20) as executor:
-                chosen_steps = list(executor.map(process_step, steps))
+            for step, verdict in zip(steps, verdicts):
+                if verdict is None:
+                    # Cut short after a rejection, whose Suggest below raises
+                    continue
+                annotation, score = verdict
+                # The response may be generated before the steps are checked, so
+                # point the backtrack at the rationale, not the latest predictor
+                dspy.Suggest(
+                    result=annotation == StepAnnotation.ESSENTIAL_AND_VALID.value,
+                    msg="Each step in the thought process must be necessary for reaching an answer and be logically and factually valid.",
+                    target_module=self.task.generate.signature,
+                )
+                chosen_steps.append((step, score))
         except dspy.DSPySuggestionError as e:
             raise e from e
 
-        response = self.conversational(
-            raw_message_from_user=message,
-            structured_message=str(structured_message),
-            rationale=answer.answer,
-        )
+        if response is None:
+            response = respond()
+            objective_verdict = self.objective_verifier.verify_step(
+                objective=objective,
+                step_to_be_verified=response.response_to_user,
+                chat_history=chat_history,
+                reasoning_chain=steps,
+            )
+
+        if objective_verdict is not None:
+            objective_annotation, _ = objective_verdict
+            dspy.Suggest(
+                result=(objective_annotation == StepAnnotation.ESSENTIAL_AND_VALID),
+                msg="The answer must meet the user's objectives.",
+            )
+
+        return chosen_steps, response
+
+
+CAPPY_MODEL = "btan2/cappy-large"
 
-        objective_annotation = self.objective_verifier.verify_step(
-            objective=structured_message.what_is_user_objective,
-            step_to_be_verified=response.response_to_user,
-            chat_history=chat_history,
-            reasoning_chain=steps,
-        )
 
-        dspy.Suggest(
-            result=(objective_annotation == StepAnnotation.ESSENTIAL_AND_VALID),
-            msg="The answer must meet the user's objectives.",
+def from_pretrained(cls, name: str, **kwargs):
+    """Load from the local Hugging Face cache, only reaching the hub when nothing is cached yet"""
+    try:
+        return cls.from_pretrained(name, local_files_only=True, **kwargs)
+    except OSError:
+        return cls.from_pretrained(name, **kwargs)
+
+
+CAPPY_INT8_DIR = CACHE_DIR / "cappy-large-int8"
+
+
+def load_quantized_cappy():
+    """Cappy exported to ONNX Runtime with dynamic int8 weights, for machines without a GPU"""
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    if not (CAPPY_INT8_DIR / "model_quantized.onnx").exists():
+        model = from_pretrained(
+            ORTModelForSequenceClassification, CAPPY_MODEL, export=True
+        )
+        quantization_config = (
+            AutoQuantizationConfig.arm64
+            if platform.machine().lower() in ("arm64", "aarch64")
+            else AutoQuantizationConfig.avx512_vnni
+        )(is_static=False, per_channel=False)
+        ORTQuantizer.from_pretrained(model).quantize(
+            save_dir=CAPPY_INT8_DIR, quantization_config=quantization_config
         )
 
-        return chosen_steps, response
+    return ORTModelForSequenceClassification.from_pretrained(
+        CAPPY_INT8_DIR,
+        file_name="model_quantized.onnx",
+        provider="CPUExecutionProvider",
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def load_cappy() -> Tuple[AutoTokenizer, AutoModel]:
+    tokenizer = from_pretrained(AutoTokenizer, CAPPY_MODEL)
+    if DEVICE == "cpu":
+        return tokenizer, load_quantized_cappy()
+
+    model = (
+        from_pretrained(
+            AutoModelForSequenceClassification, CAPPY_MODEL, torch_dtype=DTYPE
+        )
+        .to(DEVICE)
+        .eval()
+    )
+    if DEVICE == "cuda":
+        model = torch.compile(model, mode="reduce-overhead")
+    return tokenizer, model
 
 
 @app.command()
@@ -351,13 +794,18 @@ def chat(
     model: Annotated[
         LanguageModel, typer.Option(help="Name of one of the local models.")
     ] = LanguageModel.M_7_B,
+    retry: Annotated[
+        bool,
+        typer.Option(help="If retry, failed suggestions are retried with feedback."),
+    ] = False,
 ):
+    if debug:
+        logging.basicConfig(stream=sys.stdout)
+        logger.setLevel(logging.DEBUG)
+
     lm = dspy.OllamaLocal(model=model.value)
 
-    cappy_tokenizer = AutoTokenizer.from_pretrained("btan2/cappy-large")
-    cappy = AutoModelForSequenceClassification.from_pretrained("btan2/cappy-large").to(
-        DEVICE
-    )
+    cappy_tokenizer, cappy = load_cappy()
     cappy_verifier = BertClassifierVerifier(tokenizer=cappy_tokenizer, model=cappy)
 
     # roscoe_tokenizer = AutoTokenizer.from_pretrained("facebook/roscoe-512-roberta-base")
@@ -367,11 +815,19 @@ def chat(
     # roscoe_verifier = BertClassifierVerifier(tokenizer=roscoe_tokenizer, model=roscoe)
 
     with dspy.context(lm=lm, trace=[]):
-        agent = assert_transform_module(
-            VerifiedQA(
-                step_verifier=cappy_verifier, objective_verifier=cappy_verifier
-            ).map_named_predictors(Retry),
-            functools.partial(backtrack_handler, max_backtracks=2),
+        agent = VerifiedQA(
+            step_verifier=cappy_verifier,
+            objective_verifier=cappy_verifier,
+        )
+        # assert_transform_module maps every predictor to Retry and backtracks,
+        # multiplying LM calls; without retry run a single pass that only logs
+        # failed suggestions
+        agent = (
+            assert_transform_module(
+                agent, functools.partial(backtrack_handler, max_backtracks=2)
+            )
+            if retry
+            else bypass_suggest_handler(agent)
         )
 
         reasoning, response = agent(message)
@@ -389,10 +845,11 @@ def cappy(
         bool, typer.Option(help="If debug, values should be printed to stdout.")
     ] = False,
 ):
-    cappy_tokenizer = AutoTokenizer.from_pretrained("btan2/cappy-large")
-    cappy_model = AutoModelForSequenceClassification.from_pretrained(
-        "btan2/cappy-large"
-    ).to(DEVICE)
+    if debug:
+        logging.basicConfig(stream=sys.stdout)
+        logger.setLevel(logging.DEBUG)
+
+    cappy_tokenizer, cappy_model = load_cappy()
 
     cappy = BertClassifierVerifier(tokenizer=cappy_tokenizer, model=cappy_model)
     objective = "build a small rocket that can reach the moon"